@@ -9,4 +9,4 @@ from .ns_markov import NSMarkovBuilder
 from .ns_zongyi import NSZongyiBuilder
 from .plasticity import PlasticityBuilder
 from .structured_mesh_2d import StructuredMesh2DBuilder
-from .utils import collate_jax
+from .utils import CudaPrefetcher, collate_jax
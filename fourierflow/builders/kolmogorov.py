@@ -1,8 +1,10 @@
 import logging
+import os
 import time
 from functools import partial
-from typing import Callable, Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
+import h5py
 import jax
 import jax.numpy as jnp
 import numpy as np
@@ -16,11 +18,12 @@ from jax_cfd.base.initial_conditions import (filtered_velocity_field)
                                             #  wrap_velocities)
 from jax_cfd.base.resize import downsample_staggered_velocity
 from jax_cfd.spectral.utils import vorticity_to_velocity
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, get_worker_info
 
 from fourierflow.utils import downsample_vorticity_hat, import_string
 
 from .base import Builder
+from .utils import CudaPrefetcher
 
 # NOTE: Currently, wrap_velocities from jax cfd throws an error. We don't use it in benchmarking so set it to None
 wrap_velocities = None
@@ -29,23 +32,136 @@ logger = logging.getLogger(__name__)
 
 KEYS = ['vx', 'vy', 'vz']
 
+# Compiled trajectory functions used by `generate_kolmogorov`, keyed by the
+# simulation config.
+_TRAJECTORY_FNS: Dict[tuple, Tuple[Callable, Callable]] = {}
+_CLEAR_CACHES_EVERY = 100
+_N_CALLS = 0
+
+
+class _H5Cache:
+    """Keep an HDF5 file open and cache the handles to its variables.
+
+    Going through h5py directly avoids the per-access overhead of xarray and
+    h5netcdf; each slice of a cached handle maps to a single hyperslab read.
+    The file is opened lazily, since h5py handles don't survive a fork and
+    each dataloader worker needs to open its own copy.
+    """
+
+    def __init__(self, path, rdcc_nbytes=64 << 20, rdcc_nslots=None):
+        self.path = path
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        self.file = None
+        self.handles = {}
+        self.pid = None
+
+    def open(self):
+        self.file = h5py.File(self.path, 'r', rdcc_nbytes=self.rdcc_nbytes,
+                              rdcc_nslots=self.rdcc_nslots)
+        self.handles = {}
+        self.pid = os.getpid()
+
+    def handle(self, key):
+        if self.file is None or self.pid != os.getpid():
+            self.open()
+        if key not in self.handles:
+            self.handles[key] = self.file[key]
+        return self.handles[key]
+
+    def __getitem__(self, key):
+        return _H5Array(self, key)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(file=None, handles={}, pid=None)
+        return state
+
+
+class _H5Array:
+    def __init__(self, cache: _H5Cache, key: str):
+        self.cache = cache
+        self.key = key
+
+    def __getitem__(self, index):
+        return self.cache.handle(self.key)[index]
+
+
+def load_array(da: xr.DataArray, h5: _H5Cache, in_memory: bool = False):
+    """Return the raw array of a variable in (sample, time, x, y) layout.
+
+    When `in_memory` is set, the data is loaded into a contiguous numpy array
+    so that indexing it is a plain numpy slice. Otherwise we return a lazy
+    handle to the h5py dataset, which reads only the requested slice from
+    disk.
+    """
+    dims = ('sample', 'time', 'x', 'y')
+    if in_memory:
+        return np.ascontiguousarray(da.transpose(*dims).values)
+    assert da.dims == dims, f'Expected {da.name} to have dims {dims}'
+    return h5[da.name]
+
+
+def load_trajectories(init_path, path, keys=('vorticity', 'vx', 'vy')):
+    """Load trajectories together with their initial conditions.
+
+    Each variable is written into a single preallocated array of shape
+    [sample, x, y, time + 1], with the initial condition in the first time
+    slot, so that no intermediate xarray concatenation is needed.
+    """
+    ds = xr.open_dataset(path, engine='h5netcdf')
+    init_ds = xr.open_dataset(init_path, engine='h5netcdf')
+    times = np.concatenate([[0.0], ds.time.values])
+
+    B, X, Y, T = len(ds.sample), len(ds.x), len(ds.y), len(ds.time)
+    arrays = {}
+    for key in keys:
+        array = np.empty((B, X, Y, T + 1), dtype=ds[key].dtype)
+        array[..., 0] = init_ds[key].transpose('sample', 'x', 'y').values
+        array[..., 1:] = ds[key].transpose('sample', 'x', 'y', 'time').values
+        arrays[key] = array
+
+    return times, arrays
+
+
+def open_files(worker_id):
+    """Open the HDF5 files of a dataset in a new dataloader worker.
+
+    Each worker needs its own file handles. Opening them upfront means that
+    the first batch of each worker doesn't pay for it.
+    """
+    dataset = get_worker_info().dataset
+    if hasattr(dataset, 'open_files'):
+        dataset.open_files()
+
 
 class KolmogorovBuilder(Builder):
     name = 'kolmogorov'
 
     def __init__(self, train_dataset, valid_dataset, test_dataset,
-                 loader_target: str = 'torch.utils.data.DataLoader', **kwargs):
+                 loader_target: str = 'torch.utils.data.DataLoader',
+                 prefetch_cuda: bool = False, **kwargs):
         super().__init__()
+        kwargs.setdefault('pin_memory', True)
+        if kwargs.get('num_workers', 0) > 0:
+            # Keep the workers alive across epochs so that they don't need to
+            # be forked and reopen the data files at the start of every epoch.
+            kwargs.setdefault('persistent_workers', True)
+            kwargs.setdefault('prefetch_factor', 4)
+            kwargs.setdefault('worker_init_fn', open_files)
         self.kwargs = kwargs
         self.train_dataset = train_dataset
         self.valid_dataset = valid_dataset
         self.test_dataset = test_dataset
         self.DataLoader = import_string(loader_target)
+        self.prefetch_cuda = prefetch_cuda
 
     def train_dataloader(self) -> DataLoader:
         loader = self.DataLoader(self.train_dataset,
                                  shuffle=True,
                                  **self.kwargs)
+        if self.prefetch_cuda:
+            loader = CudaPrefetcher(loader)
         return loader
 
     def val_dataloader(self) -> DataLoader:
@@ -62,26 +178,34 @@ class KolmogorovBuilder(Builder):
 
     def inference_data(self):
         k = self.test_dataset.k
-        ds = self.test_dataset.ds.isel(time=slice(None, None, k))
         data = {
-            'data': ds.vorticity.data,
-            'vx': ds.vx.data,
-            'vy': ds.vy.data,
+            'data': self.test_dataset.vorticity[..., ::k],
+            'vx': self.test_dataset.vx[..., ::k],
+            'vy': self.test_dataset.vy[..., ::k],
         }
         return data
 
 
 class KolmogorovJAXDataset(Dataset):
     def __init__(self, path, k, unroll_length, in_memory=False):
-        self.ds = xr.open_dataset(path, engine='h5netcdf')
+        self.h5 = _H5Cache(path)
+        self.in_memory = in_memory
         self.k = k
-        self.B = len(self.ds.sample)
         self.L = unroll_length
-        self.T = len(self.ds.time) - self.k * self.L
 
         if in_memory:
             logger.info('Loading dataset into memory...')
-            self.ds.load()
+        # Close the xarray handle before h5py opens the file. Otherwise
+        # HDF5 reuses the already open file and ignores our cache settings.
+        with xr.open_dataset(path, engine='h5netcdf') as ds:
+            self.B = len(ds.sample)
+            self.T = len(ds.time) - self.k * self.L
+            self.vx = load_array(ds.vx, self.h5, in_memory)
+            self.vy = load_array(ds.vy, self.h5, in_memory)
+
+    def open_files(self):
+        if not self.in_memory:
+            self.h5.open()
 
     def __len__(self):
         return self.B * self.T
@@ -92,20 +216,21 @@ class KolmogorovJAXDataset(Dataset):
         k = self.k
         L = self.L
 
-        ds = self.ds.isel(sample=b, time=slice(t, t+L*k+1, k))
-        in_ds = ds.isel(time=0)
-        out_ds = ds.isel(time=slice(1, None, None)).transpose('x', 'y', 'time')
+        time_slice = slice(t, t+L*k+1, k)
+        vx = np.asarray(self.vx[b, time_slice])
+        vy = np.asarray(self.vy[b, time_slice])
+        # vx.shape == [L + 1, x, y]
 
         inputs = {
-            'vx': in_ds.vx.data,
-            'vy': in_ds.vy.data,
-            # 'vorticity': in_ds.vorticity,
+            'vx': vx[0],
+            'vy': vy[0],
         }
 
+        # Transposing a numpy array only swaps the strides, so no copy
+        # is made here.
         outputs = {
-            'vx': out_ds.vx.data,
-            'vy': out_ds.vy.data,
-            # 'vorticity': out_ds.vorticity,
+            'vx': vx[1:].transpose(1, 2, 0),
+            'vy': vy[1:].transpose(1, 2, 0),
         }
 
         return inputs, outputs
@@ -113,14 +238,24 @@ class KolmogorovJAXDataset(Dataset):
 
 class KolmogorovTorchDataset(Dataset):
     def __init__(self, path, k, in_memory=False):
-        self.ds = xr.open_dataset(path, engine='h5netcdf')
+        self.h5 = _H5Cache(path)
+        self.in_memory = in_memory
         self.k = k
-        self.B = len(self.ds.sample)
-        self.T = len(self.ds.time) - self.k
 
         if in_memory:
             logger.info('Loading dataset into memory...')
-            self.ds.load()
+        # Close the xarray handle before h5py opens the file. Otherwise
+        # HDF5 reuses the already open file and ignores our cache settings.
+        with xr.open_dataset(path, engine='h5netcdf') as ds:
+            self.B = len(ds.sample)
+            self.T = len(ds.time) - self.k
+            self.vorticity = load_array(ds.vorticity, self.h5, in_memory)
+            self.vx = load_array(ds.vx, self.h5, in_memory)
+            self.vy = load_array(ds.vy, self.h5, in_memory)
+
+    def open_files(self):
+        if not self.in_memory:
+            self.h5.open()
 
     def __len__(self):
         return self.B * self.T
@@ -130,28 +265,47 @@ class KolmogorovTorchDataset(Dataset):
         t = idx % self.T
         k = self.k
 
-        ds = self.ds.isel(sample=b, time=slice(t, t+k+1, k))
-        in_ds = ds.isel(time=slice(0, 1)).transpose('x', 'y', 'time')
-        out_ds = ds.isel(time=slice(1, 2)).transpose('x', 'y', 'time')
+        time_slice = slice(t, t+k+1, k)
+        vorticity = np.asarray(self.vorticity[b, time_slice])
+        vx = np.asarray(self.vx[b, t])
+        vy = np.asarray(self.vy[b, t])
+        # vorticity.shape == [2, x, y]
 
         return {
-            'x': in_ds.vorticity.data,
-            'vx': in_ds.vx.data,
-            'vy': in_ds.vy.data,
-            'y': out_ds.vorticity.data,
+            'x': vorticity[0:1].transpose(1, 2, 0),
+            'vx': vx[..., None],
+            'vy': vy[..., None],
+            'y': vorticity[1:2].transpose(1, 2, 0),
         }
 
 
 class KolmogorovMultiTorchDataset(Dataset):
     def __init__(self, paths, k, batch_size):
-        self.dss = [xr.open_dataset(path, engine='h5netcdf') for path in paths]
+        # We alternate between files every batch, so give each file a chunk
+        # cache that is large enough to hold its recently read chunks. The
+        # number of slots should be a prime number much larger than the
+        # number of chunks in the cache.
+        self.h5s = [_H5Cache(path, rdcc_nbytes=256 << 20,
+                             rdcc_nslots=1_000_003) for path in paths]
         self.k = k
-        self.B = len(self.dss[0].sample)
-        self.T = len(self.dss[0].time) - self.k
+
+        # The xarray handles must be closed before h5py opens the files,
+        # since HDF5 would otherwise reuse them without our cache settings.
+        with xr.open_dataset(paths[0], engine='h5netcdf') as ds:
+            self.B = len(ds.sample)
+            self.T = len(ds.time) - self.k
+        self.vorticities = []
+        for path, h5 in zip(paths, self.h5s):
+            with xr.open_dataset(path, engine='h5netcdf') as ds:
+                self.vorticities.append(load_array(ds.vorticity, h5))
         self.counter = 0
         self.batch_size = batch_size
         self.ds_index = 0
 
+    def open_files(self):
+        for h5 in self.h5s:
+            h5.open()
+
     def __len__(self):
         return self.B * self.T
 
@@ -160,57 +314,56 @@ class KolmogorovMultiTorchDataset(Dataset):
         t = idx % self.T
         k = self.k
 
-        ds = self.dss[self.ds_index]
-        ds = ds.isel(sample=b, time=slice(t, t+k+1, k))
-        in_ds = ds.isel(time=slice(0, 1)).transpose('x', 'y', 'time')
-        out_ds = ds.isel(time=slice(1, 2)).transpose('x', 'y', 'time')
+        vorticity = self.vorticities[self.ds_index]
+        vorticity = np.asarray(vorticity[b, t:t+k+1:k])
+        # vorticity.shape == [2, x, y]
         self.update_counter()
 
         return {
-            'x': in_ds.vorticity.data,
-            'y': out_ds.vorticity.data,
+            'x': vorticity[0:1].transpose(1, 2, 0),
+            'y': vorticity[1:2].transpose(1, 2, 0),
         }
 
     def update_counter(self):
         self.counter += 1
         if self.counter % self.batch_size == 0:
-            self.ds_index = (self.ds_index + 1) % len(self.dss)
+            self.ds_index = (self.ds_index + 1) % len(self.h5s)
 
 
 class KolmogorovTrajectoryDataset(Dataset):
     def __init__(self, init_path, path, corr_path, k, end=None, in_memory=False):
-        ds = xr.open_dataset(path, engine='h5netcdf')
-        init_ds = xr.open_dataset(init_path, engine='h5netcdf')
-        init_ds = init_ds.expand_dims(dim={'time': [0.0]})
-        ds = xr.concat([init_ds, ds], dim='time')
-        self.ds = ds.transpose('sample', 'x', 'y', 'time')
+        self.times, arrays = load_trajectories(init_path, path)
+        self.vorticity = arrays['vorticity']
+        self.vx = arrays['vx']
+        self.vy = arrays['vy']
 
-        corr_ds = xr.open_dataset(corr_path, engine='h5netcdf')
-        self.corr_ds = corr_ds.transpose('sample', 'x', 'y', 'time')
+        self.corr_h5 = _H5Cache(corr_path)
 
         self.k = k
-        self.B = len(self.ds.sample)
+        self.B = len(self.vorticity)
         self.end = end
 
         if in_memory:
             logger.info('Loading datasets into memory...')
-            self.ds.load()
-            self.corr_ds.load()
+        with xr.open_dataset(corr_path, engine='h5netcdf') as corr_ds:
+            self.corr_vorticity = load_array(
+                corr_ds.vorticity, self.corr_h5, in_memory)
 
     def __len__(self):
         return self.B
 
     def __getitem__(self, b):
         time_slice = slice(None, self.end, self.k)
-        ds = self.ds.isel(sample=b, time=time_slice)
-        corr_ds = self.corr_ds.isel(sample=b, time=time_slice)
+        corr_vorticity = np.asarray(self.corr_vorticity[b, time_slice])
+        # corr_vorticity.shape == [time, x, y]
 
+        # These are all strided views into the preloaded arrays.
         out = {
-            'times': ds.time.data,
-            'data': ds.vorticity.data,
-            'vx': ds.vx.data,
-            'vy': ds.vy.data,
-            'corr_data': corr_ds.vorticity.data,
+            'times': self.times[time_slice],
+            'data': self.vorticity[b, :, :, time_slice],
+            'vx': self.vx[b, :, :, time_slice],
+            'vy': self.vy[b, :, :, time_slice],
+            'corr_data': corr_vorticity.transpose(1, 2, 0),
         }
         return out
 
@@ -218,42 +371,43 @@ class KolmogorovTrajectoryDataset(Dataset):
 class KolmogorovJAXTrajectoryDataset(Dataset):
     def __init__(self, init_path, path, corr_path, k, end=None,
                  inner_steps=1, outer_steps=100, in_memory=False):
-        ds = xr.open_dataset(path, engine='h5netcdf')
-        init_ds = xr.open_dataset(init_path, engine='h5netcdf')
-        init_ds = init_ds.expand_dims(dim={'time': [0.0]})
-        ds = xr.concat([init_ds, ds], dim='time')
-        self.ds = ds.transpose('sample', 'x', 'y', 'time')
+        self.times, arrays = load_trajectories(init_path, path)
+        self.vorticity = arrays['vorticity']
+        self.vx = arrays['vx']
+        self.vy = arrays['vy']
 
-        corr_ds = xr.open_dataset(corr_path, engine='h5netcdf')
-        self.corr_ds = corr_ds.transpose('sample', 'x', 'y', 'time')
+        self.corr_h5 = _H5Cache(corr_path)
 
         self.k = k
-        self.B = len(self.ds.sample)
+        self.B = len(self.vorticity)
         self.end = end
         self.inner_steps = inner_steps
         self.outer_steps = outer_steps
 
         if in_memory:
             logger.info('Loading datasets into memory...')
-            self.ds.load()
-            self.corr_ds.load()
+        with xr.open_dataset(corr_path, engine='h5netcdf') as corr_ds:
+            self.corr_times = corr_ds.time.values
+            self.corr_vorticity = load_array(
+                corr_ds.vorticity, self.corr_h5, in_memory)
 
     def __len__(self):
         return self.B
 
     def __getitem__(self, b):
         time_slice = slice(None, self.end, self.k)
-        ds = self.ds.isel(sample=b, time=time_slice)
-        corr_ds = self.corr_ds.isel(sample=b, time=time_slice)
+        corr_vorticity = np.asarray(self.corr_vorticity[b, time_slice])
+        corr_vorticity = corr_vorticity.transpose(1, 2, 0)
+        # corr_vorticity.shape == [x, y, time]
 
         s = self.inner_steps
         e = s + self.outer_steps * s
 
         out = {
-            'times': corr_ds.time.data[..., s:e:s],
-            'vx': ds.vx.data[..., 0],
-            'vy': ds.vy.data[..., 0],
-            'targets': corr_ds.vorticity.data[..., s:e:s],
+            'times': self.corr_times[time_slice][s:e:s],
+            'vx': self.vx[b, :, :, 0],
+            'vy': self.vy[b, :, :, 0],
+            'targets': corr_vorticity[..., s:e:s],
         }
         return out
 
@@ -343,11 +497,98 @@ def generate_kolmogorov(sim_grid: Grid,
                         out_vorticity: bool = True):
     """Generate 2D Kolmogorov flows, similar to Kochkov et al (2021).
 
+    A whole batch of trajectories is simulated at once: `seed` contains one
+    PRNG key per trajectory and `initial_field`, if given, has a leading
+    `sample` dimension of the same size. The outputs have a leading batch
+    axis and the returned elapsed time is the wall time per trajectory.
+
     Adapted from https://github.com/google/jax-cfd/blob/main/notebooks/demo.ipynb
     """
     # Seems that there is some memory leak, especially when generating
-    # re_1000/short_trajectories
-    jax.lib.xla_bridge.get_backend.cache_clear()
+    # re_1000/short_trajectories. We used to reset the whole XLA backend on
+    # every call, which also threw away all compiled functions. Now we only
+    # do it once in a while, and recompile the trajectory function after.
+    global _N_CALLS
+    _N_CALLS += 1
+    if _N_CALLS % _CLEAR_CACHES_EVERY == 0:
+        _TRAJECTORY_FNS.clear()
+        if hasattr(jax, 'clear_caches'):
+            jax.clear_caches()
+        else:
+            jax.lib.xla_bridge.get_backend.cache_clear()
+
+    if initial_field is None:
+        batch_size = len(seed)
+
+        def init_state(key):
+            # Construct a random initial velocity. The
+            # `filtered_velocity_field` function ensures that the initial
+            # velocity is divergence free and it filters out high frequency
+            # fluctuations.
+            v0 = filtered_velocity_field(
+                key, sim_grid, max_velocity, peak_wavenumber)
+            if method == 'pseudo_spectral':
+                # Compute the fft of the vorticity. The spectral code assumes
+                # an fft'd vorticity for an initial state.
+                vorticity0 = curl_2d(v0).data
+                return jnp.fft.rfftn(vorticity0, axes=(0, 1))
+            return v0
+
+        state = jax.vmap(init_state)(seed)
+    else:
+        batch_size = len(initial_field.sample)
+        if method == 'pseudo_spectral':
+            dims = ['sample', 'x', 'y']
+            vorticity0 = initial_field.vorticity.transpose(*dims).values
+            state = jnp.fft.rfftn(vorticity0, axes=(1, 2))
+        else:
+            u, bcs = [], []
+            for i in range(sim_grid.ndim):
+                u.append(initial_field[KEYS[i]].data)
+                bcs.append(periodic_boundary_conditions(sim_grid.ndim))
+            state = wrap_velocities(u, sim_grid, bcs)
+
+    # Compiling the trajectory function takes a while, so we reuse it across
+    # all trajectories generated with the same config and batch size.
+    n_steps = warmup_steps if warmup_steps > 0 else outer_steps
+    cache_key = (str(step_fn), sim_grid, method, inner_steps, n_steps,
+                 warmup_steps > 0, str(out_sizes), downsample_fn,
+                 out_vorticity, batch_size)
+    if cache_key not in _TRAJECTORY_FNS:
+        # Drop the functions compiled for other configs so that their
+        # executables can be freed.
+        _TRAJECTORY_FNS.clear()
+        trajectory_fn, downsample = _build_trajectory_fn(
+            sim_grid, out_sizes, step_fn, downsample_fn, inner_steps,
+            warmup_steps, outer_steps, out_vorticity)
+        # Compile ahead of time so that the compile time doesn't end up in
+        # the elapsed time that we report.
+        trajectory_fn = trajectory_fn.lower(state).compile()
+        _TRAJECTORY_FNS[cache_key] = trajectory_fn, downsample
+    trajectory_fn, downsample = _TRAJECTORY_FNS[cache_key]
+
+    # Make sure that the initial state is ready before we start the clock.
+    state = jax.block_until_ready(state)
+
+    # During warming up, we ignore intermediate results and just return
+    # the final field
+    if warmup_steps > 0:
+        start = time.time()
+        state, _ = jax.block_until_ready(trajectory_fn(state))
+        elapsed = np.float32((time.time() - start) / batch_size)
+        outs = downsample(state)
+        return outs, elapsed
+
+    if outer_steps > 0:
+        start = time.time()
+        _, trajs = jax.block_until_ready(trajectory_fn(state))
+        elapsed = np.float32((time.time() - start) / batch_size)
+        return trajs, elapsed
+
+
+def _build_trajectory_fn(sim_grid, out_sizes, step_fn, downsample_fn,
+                         inner_steps, warmup_steps, outer_steps,
+                         out_vorticity):
     # Define the physical dimensions of the simulation.
     velocity_solve = vorticity_to_velocity(
         sim_grid) if sim_grid.ndim == 2 else None
@@ -359,69 +600,36 @@ def generate_kolmogorov(sim_grid: Grid,
 
     downsample = partial(downsample_fn, sim_grid, out_grids,
                          velocity_solve, out_vorticity)
-
-    if initial_field is None:
-        # Construct a random initial velocity. The `filtered_velocity_field`
-        # function ensures that the initial velocity is divergence free and it
-        # filters out high frequency fluctuations.
-        v0 = filtered_velocity_field(
-            seed, sim_grid, max_velocity, peak_wavenumber)
-        if method == 'pseudo_spectral':
-            # Compute the fft of the vorticity. The spectral code assumes an fft'd
-            # vorticity for an initial state.
-            vorticity0 = curl_2d(v0).data
-    else:
-        u, bcs = [], []
-        for i in range(sim_grid.ndim):
-            u.append(initial_field[KEYS[i]].data)
-            bcs.append(periodic_boundary_conditions(sim_grid.ndim))
-        v0 = wrap_velocities(u, sim_grid, bcs)
-        if method == 'pseudo_spectral':
-            vorticity0 = initial_field.vorticity.values
-
-    if method == 'pseudo_spectral':
-        state = jnp.fft.rfftn(vorticity0, axes=(0, 1))
-    else:
-        state = v0
+    batched_downsample = jax.vmap(downsample)
 
     step_fn = instantiate(step_fn)
     # step_fn = get_learned_interpolation_step_fn(sim_grid)
     outer_step_fn = repeated(step_fn, inner_steps)
 
-    # During warming up, we ignore intermediate results and just return
-    # the final field
     if warmup_steps > 0:
         def ignore(_):
             return None
         trajectory_fn = trajectory(outer_step_fn, warmup_steps, ignore)
-        start = time.time()
-        state, _ = trajectory_fn(state)
-        elapsed = np.float32(time.time() - start)
-        outs = downsample(state)
-        return outs, elapsed
-
-    if outer_steps > 0:
-        start = time.time()
+    else:
         trajectory_fn = trajectory(outer_step_fn, outer_steps, downsample)
-        _, trajs = trajectory_fn(state)
-        elapsed = np.float32(time.time() - start)
-        return trajs, elapsed
+
+    # Simulate all trajectories in the batch together. The initial state is
+    # not needed after the call, so XLA can reuse its buffer.
+    trajectory_fn = jax.jit(jax.vmap(trajectory_fn), donate_argnums=(0,))
+
+    return trajectory_fn, batched_downsample
 
 
 def downsample_vorticity(sim_grid, out_grids, velocity_solve, out_vorticity, vorticity_hat):
     outs = {}
+    # Output sizes that are saved at several time resolutions share the
+    # same downsampled fields.
+    downsampled = {}
     for key, out_grid in out_grids.items():
-        size = key[0]
-        if size == sim_grid.shape[0]:
-            vxhat, vyhat = velocity_solve(vorticity_hat)
-            out = {
-                'vx': jnp.fft.irfftn(vxhat, axes=(0, 1)),
-                'vy': jnp.fft.irfftn(vyhat, axes=(0, 1)),
-                'vorticity': jnp.fft.irfftn(vorticity_hat, axes=(0, 1)),
-            }
-        else:
-            out = downsample_vorticity_hat(
-                vorticity_hat, velocity_solve, sim_grid, out_grid)
+        if out_grid not in downsampled:
+            downsampled[out_grid] = _downsample_vorticity(
+                sim_grid, out_grid, velocity_solve, vorticity_hat)
+        out = dict(downsampled[out_grid])
         if not out_vorticity:
             del out['vorticity']
         outs[key] = out
@@ -431,25 +639,43 @@ def downsample_vorticity(sim_grid, out_grids, velocity_solve, out_vorticity, vor
     return outs
 
 
+@partial(jax.jit, static_argnums=(0, 1, 2))
+def _downsample_vorticity(sim_grid, out_grid, velocity_solve, vorticity_hat):
+    if out_grid.shape[0] == sim_grid.shape[0]:
+        vxhat, vyhat = velocity_solve(vorticity_hat)
+        # Transform all three fields back with a single batched inverse FFT.
+        fields_hat = jnp.stack([vxhat, vyhat, vorticity_hat], axis=0)
+        fields = jnp.fft.irfftn(fields_hat, axes=(1, 2))
+        return {
+            'vx': fields[0],
+            'vy': fields[1],
+            'vorticity': fields[2],
+        }
+    return downsample_vorticity_hat(
+        vorticity_hat, velocity_solve, sim_grid, out_grid)
+
+
 def downsample_velocity(sim_grid, out_grids, velocity_solve, out_vorticity, u):
     outs = {}
+    downsampled = {}
     for key, out_grid in out_grids.items():
-        size = key[0]
-        out = {}
-        if size == sim_grid.shape[0]:
-            for i in range(sim_grid.ndim):
-                out[KEYS[i]] = u[i].data
-            if sim_grid.ndim == 2 and out_vorticity:
-                out['vorticity'] = curl_2d(u).data
-        else:
-            u_new = downsample_staggered_velocity(
-                sim_grid, out_grid, u)
-            for i in range(sim_grid.ndim):
-                out[KEYS[i]] = u_new[i].data
-            if sim_grid.ndim == 2 and out_vorticity:
-                out['vorticity'] = curl_2d(u_new).data
-        outs[key] = out
+        if out_grid not in downsampled:
+            downsampled[out_grid] = _downsample_velocity(
+                sim_grid, out_grid, out_vorticity, u)
+        outs[key] = dict(downsampled[out_grid])
 
     # cpu = jax.devices('cpu')[0]
     # outs = {k: jax.device_put(v, cpu) for k, v in outs.items()}
     return outs
+
+
+@partial(jax.jit, static_argnums=(0, 1, 2))
+def _downsample_velocity(sim_grid, out_grid, out_vorticity, u):
+    out = {}
+    if out_grid.shape[0] != sim_grid.shape[0]:
+        u = downsample_staggered_velocity(sim_grid, out_grid, u)
+    for i in range(sim_grid.ndim):
+        out[KEYS[i]] = u[i].data
+    if sim_grid.ndim == 2 and out_vorticity:
+        out['vorticity'] = curl_2d(u).data
+    return out
@@ -64,11 +64,15 @@ class NavierStokesTrainingDataset(Dataset):
             f = self.f[b, ::self.ssr, ::self.ssr]
         else:
             f = self.f[b, ::self.ssr, ::self.ssr, t + self.k]
+        x = self.u[b, ::self.ssr, ::self.ssr, t:t+1]
+        y = self.u[b, ::self.ssr, ::self.ssr, t+self.k:t+self.k+1]
+
+        # Generated data may be stored in half precision.
         return {
-            'x': self.u[b, ::self.ssr, ::self.ssr, t:t+1],
-            'y': self.u[b, ::self.ssr, ::self.ssr, t+self.k:t+self.k+1],
+            'x': x.astype(np.float32, copy=False),
+            'y': y.astype(np.float32, copy=False),
             'mu': self.mu[b],
-            'f': f,
+            'f': f.astype(np.float32, copy=False),
         }
 
 
@@ -94,8 +98,11 @@ class NavierStokesDataset(Dataset):
         else:
             f = self.f[b, ::self.ssr, ::self.ssr, ::self.k]
 
+        data = self.u[b, ::self.ssr, ::self.ssr, ::self.k]
+
+        # Generated data may be stored in half precision.
         return {
-            'data': self.u[b, ::self.ssr, ::self.ssr, ::self.k],
+            'data': data.astype(np.float32, copy=False),
             'mu': self.mu[b],
-            'f': f,
+            'f': f.astype(np.float32, copy=False),
             'times': self.times}
@@ -6,6 +6,7 @@ https://github.com/zongyi-li/fourier_neural_operator/blob/master/data_generation
 
 import math
 from enum import Enum
+from functools import lru_cache
 
 import numpy as np
 import torch
@@ -61,14 +62,13 @@ def solve_navier_stokes_2d(w0, visc, T, delta_t, record_steps, cycles=None,
         # Forcing function: 0.1*(sin(2pi(x+y)) + cos(2pi(x+y)))
         ft = torch.linspace(0, 1, N+1, device=w0.device)
         ft = ft[0:-1]
-        X, Y = torch.meshgrid(ft, ft, indexing='ij')
-        f = 0.1*(torch.sin(2 * math.pi * (X + Y)) +
-                 torch.cos(2 * math.pi * (X + Y)))
+        # Broadcasting gives the (N, N) grid of x + y without a meshgrid.
+        phase = 2 * math.pi * (ft[:, None] + ft[None, :])
+        f = 0.1*(torch.sin(phase) + torch.cos(phase))
     elif force == Force.kolmogorov:
         ft = torch.linspace(0, 2 * np.pi, N + 1, device=w0.device)
         ft = ft[0:-1]
-        X, Y = torch.meshgrid(ft, ft, indexing='ij')
-        f = -4 * torch.cos(4 * Y)
+        f = -4 * torch.cos(4 * ft).expand(N, N)
     elif force == Force.random and not varying_force:
         f = get_random_force(
             w0.shape[0], N, w0.device, cycles, scaling, 0, 0, seed)
@@ -200,38 +200,50 @@ def solve_navier_stokes_2d(w0, visc, T, delta_t, record_steps, cycles=None,
     return sol.cpu().numpy(), f
 
 
-def get_random_force(b, s, device, cycles, scaling, t, t_scaling, seed):
-    ft = torch.linspace(0, 1, s+1).to(device)
-    ft = ft[0:-1]
-    X, Y = torch.meshgrid(ft, ft, indexing='ij')
-    X = repeat(X, 'x y -> b x y', b=b)
-    Y = repeat(Y, 'x y -> b x y', b=b)
+@lru_cache(maxsize=None)
+def get_random_force_basis(s, device, cycles):
+    """Compute the sine and cosine terms of the random forcing function.
 
-    gen = torch.Generator(device)
-    gen.manual_seed(seed)
+    The basis only depends on the grid, so we build it once and reuse it for
+    every batch and time step.
+    """
+    ft = torch.linspace(0, 1, s+1, device=device)
+    ft = ft[0:-1]
+    X = ft[:, None].expand(s, s)
+    Y = ft[None, :].expand(s, s)
 
-    f = 0
+    basis = []
     for p in range(1, cycles + 1):
         k = 2 * math.pi * p
+        for phase in [k * X, k * Y, k * (X + Y)]:
+            basis.append(torch.sin(phase))
+            basis.append(torch.cos(phase))
+    basis = torch.stack(basis, dim=0)
+    # basis.shape == [cycles * 6, s, s]
 
-        alpha = torch.rand(b, 1, 1, generator=gen, device=device)
-        f += alpha * torch.sin(k * X + t_scaling * t)
+    return basis
 
-        alpha = torch.rand(b, 1, 1, generator=gen, device=device)
-        f += alpha * torch.cos(k * X + t_scaling * t)
 
-        alpha = torch.rand(b, 1, 1, generator=gen, device=device)
-        f += alpha * torch.sin(k * Y + t_scaling * t)
+def get_random_force(b, s, device, cycles, scaling, t, t_scaling, seed):
+    basis = get_random_force_basis(s, device, cycles)
 
-        alpha = torch.rand(b, 1, 1, generator=gen, device=device)
-        f += alpha * torch.cos(k * Y + t_scaling * t)
+    gen = torch.Generator(device)
+    gen.manual_seed(seed)
 
-        alpha = torch.rand(b, 1, 1, generator=gen, device=device)
-        f += alpha * torch.sin(k * (X + Y) + t_scaling * t)
+    alpha = torch.rand(b, cycles * 6, generator=gen, device=device)
+    # alpha.shape == [b, cycles * 6]
 
-        alpha = torch.rand(b, 1, 1, generator=gen, device=device)
-        f += alpha * torch.cos(k * (X + Y) + t_scaling * t)
+    # Shifting the phase by c = t_scaling * t mixes each (sin, cos) pair:
+    #   sin(a + c) = sin(a) cos(c) + cos(a) sin(c)
+    #   cos(a + c) = cos(a) cos(c) - sin(a) sin(c)
+    c = t_scaling * t
+    alpha_sin, alpha_cos = alpha[:, 0::2], alpha[:, 1::2]
+    coeffs = torch.stack([
+        alpha_sin * math.cos(c) - alpha_cos * math.sin(c),
+        alpha_sin * math.sin(c) + alpha_cos * math.cos(c),
+    ], dim=-1).reshape(b, -1)
 
+    f = torch.einsum('bk,kxy->bxy', coeffs, basis)
     f = f * scaling
 
     return f
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 
 def collate_jax(sample_list):
@@ -12,3 +13,78 @@ def collate_jax(sample_list):
         batch = np.stack(sample_list, axis=0)
 
     return batch
+
+
+def to_device(batch, device, non_blocking=False):
+    if torch.is_tensor(batch):
+        # Copies from pageable memory are synchronous even with
+        # non_blocking=True, so we pin the batch first if the loader hasn't.
+        if non_blocking and batch.device.type == 'cpu' \
+                and not batch.is_pinned():
+            batch = batch.pin_memory()
+        return batch.to(device, non_blocking=non_blocking)
+    elif isinstance(batch, tuple):
+        return tuple(to_device(b, device, non_blocking) for b in batch)
+    elif isinstance(batch, list):
+        return [to_device(b, device, non_blocking) for b in batch]
+    elif isinstance(batch, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in batch.items()}
+    return batch
+
+
+class CudaPrefetcher:
+    """Copy the next batch to the GPU while the current one is being used.
+
+    The copies are issued on a separate CUDA stream so that they overlap with
+    the computation on the default stream. For the copies to be truly
+    asynchronous, the loader should use pinned memory.
+    """
+
+    def __init__(self, loader, device='cuda'):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+        self.iterator = None
+        self.next_batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_batch = to_device(batch, self.device, non_blocking=True)
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        batch = self.next_batch
+
+        # Tell the caching allocator that these tensors are now used by the
+        # current stream, so their memory isn't reused too early.
+        def record_stream(x):
+            if torch.is_tensor(x):
+                x.record_stream(current_stream)
+            elif isinstance(x, (tuple, list)):
+                for elem in x:
+                    record_stream(elem)
+            elif isinstance(x, dict):
+                for elem in x.values():
+                    record_stream(elem)
+        record_stream(batch)
+
+        self._preload()
+        return batch
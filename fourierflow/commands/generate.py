@@ -1,5 +1,7 @@
 import logging
 import os
+import queue
+import threading
 from pathlib import Path
 from typing import Callable, Dict, List, Optional, Tuple
 
@@ -128,7 +130,11 @@ def kolmogorov(
         } for o in c.out_sizes}
     durations = []
 
-    for i in range(c.n_trajectories):
+    # Trajectories are simulated in batches, which keeps the GPU busy when
+    # the simulation grid is small.
+    batch_size = c.get('batch_size', 1)
+    for i in range(0, c.n_trajectories, batch_size):
+        batch = slice(i, min(i + batch_size, c.n_trajectories))
         outs = dask.delayed(generate_kolmogorov)(
             sim_grid=sim_grid,
             out_sizes=c.out_sizes,
@@ -137,34 +143,36 @@ def kolmogorov(
             downsample_fn=c.downsample_fn,
             peak_wavenumber=c.peak_wavenumber,
             max_velocity=c.max_velocity,
-            seed=keys[i],
-            initial_field=initial_ds.isel(sample=i) if init_path else None,
+            seed=keys[batch],
+            initial_field=initial_ds.isel(sample=batch) if init_path else None,
             inner_steps=c.inner_steps,
             outer_steps=c.outer_steps,
             warmup_steps=c.warmup_steps,
             out_vorticity=out_vorticity)
         trajs, elapsed = outs[0], outs[1]
 
-        for o in c.out_sizes:
-            key = (o['size'], o['k'])
-            k = o['k']
-            shape = shapes[key]
-            traj = trajs[key]
-            vx = da.from_delayed(traj['vx'][k-1::k], shape, np.float32)
-            gvars[key]['vx'].append(vx)
-
-            vy = da.from_delayed(traj['vy'][k-1::k], shape, np.float32)
-            gvars[key]['vy'].append(vy)
-
-            if sim_grid.ndim == 2 and out_vorticity:
-                vorticity = da.from_delayed(
-                    traj['vorticity'][k-1::k], shape, np.float32)
-                gvars[key]['vorticity'].append(vorticity)
-            elif sim_grid.ndim == 3:
-                vz = da.from_delayed(traj['vz'][k-1::k], shape, np.float32)
-                gvars[key]['vz'].append(vz)
-
-        durations.append(da.from_delayed(elapsed, (), np.float32))
+        for j in range(batch.stop - batch.start):
+            for o in c.out_sizes:
+                key = (o['size'], o['k'])
+                k = o['k']
+                shape = shapes[key]
+                traj = trajs[key]
+                vx = da.from_delayed(traj['vx'][j][k-1::k], shape, np.float32)
+                gvars[key]['vx'].append(vx)
+
+                vy = da.from_delayed(traj['vy'][j][k-1::k], shape, np.float32)
+                gvars[key]['vy'].append(vy)
+
+                if sim_grid.ndim == 2 and out_vorticity:
+                    vorticity = da.from_delayed(
+                        traj['vorticity'][j][k-1::k], shape, np.float32)
+                    gvars[key]['vorticity'].append(vorticity)
+                elif sim_grid.ndim == 3:
+                    vz = da.from_delayed(
+                        traj['vz'][j][k-1::k], shape, np.float32)
+                    gvars[key]['vz'].append(vz)
+
+            durations.append(da.from_delayed(elapsed, (), np.float32))
 
     for o in c.out_sizes:
         key = (o['size'], o['k'])
@@ -246,6 +254,7 @@ def navier_stokes(
     scaling: float = Option(0.1, help='Scaling of forcing function'),
     t_scaling: float = Option(0.2, help='Scaling of time variable'),
     varying_force: bool = Option(False, help='Enable time-varying force'),
+    half_precision: bool = Option(False, help='Store fields as float16'),
     debug: bool = Option(False, help='Enable debugging mode with ptvsd'),
 ):
     # This debug mode is for those who use VS Code's internal debugger.
@@ -256,6 +265,7 @@ def navier_stokes(
     device = torch.device('cuda')
     torch.manual_seed(seed)
     np.random.seed(seed + 1234)
+    rng = np.random.default_rng(seed + 1234)
 
     if os.path.dirname(path):
         os.makedirs(os.path.dirname(path), exist_ok=True)
@@ -265,14 +275,43 @@ def navier_stokes(
 
     data_f = h5py.File(path, 'a')
 
+    # Samples are written to disk in a background thread so that the disk
+    # IO overlaps with solving the next batch on the GPU.
+    write_queue: queue.Queue = queue.Queue(maxsize=2)
+    write_errors: List[Exception] = []
+
+    def write_batches():
+        while True:
+            writes = write_queue.get()
+            try:
+                for name, index, value in writes:
+                    data_f[name][index] = value
+            except Exception as e:  # pylint: disable=broad-except
+                write_errors.append(e)
+            finally:
+                write_queue.task_done()
+
+    threading.Thread(target=write_batches, daemon=True).start()
+
+    # Half precision halves the file size and the read bandwidth when
+    # training. The solver itself still runs in float32; h5py converts the
+    # values when writing.
+    dtype = np.float16 if half_precision else np.float32
+
     def generate_split(n, split):
         print('Generating split:', split)
-        data_f.create_dataset(f'{split}/a', (n, s, s), np.float32)
+        # Each sample is stored in its own uncompressed chunk, which is the
+        # fastest layout to write one batch of samples at a time.
+        data_f.create_dataset(f'{split}/a', (n, s, s), dtype,
+                              chunks=(1, s, s))
         if varying_force:
-            data_f.create_dataset(f'{split}/f', (n, s, s, steps), np.float32)
+            data_f.create_dataset(f'{split}/f', (n, s, s, steps), dtype,
+                                  chunks=(1, s, s, steps))
         else:
-            data_f.create_dataset(f'{split}/f', (n, s, s), np.float32)
-        data_f.create_dataset(f'{split}/u', (n, s, s, steps), np.float32)
+            data_f.create_dataset(f'{split}/f', (n, s, s), dtype,
+                                  chunks=(1, s, s))
+        data_f.create_dataset(f'{split}/u', (n, s, s, steps), dtype,
+                              chunks=(1, s, s, steps))
         data_f.create_dataset(f'{split}/mu', (n,), np.float32)
         b = min(n, batch_size)
         c = 0
@@ -283,24 +322,34 @@ def navier_stokes(
                 w0 = GRF.sample(b)
 
                 if mu_min != mu_max:
-                    mu = np.random.rand(b) * (mu_max - mu_min) + mu_min
+                    mu = rng.random(b) * (mu_max - mu_min) + mu_min
 
                 sol, f = solve_navier_stokes_2d(
                     w0, mu, t, delta, steps, cycles,
                     scaling, t_scaling, force, varying_force)
-                data_f[f'{split}/a'][c:(c+b), ...] = w0.cpu().numpy()
-                data_f[f'{split}/u'][c:(c+b), ...] = sol
 
+                index = slice(c, c + b)
+                writes = [(f'{split}/a', index, w0.cpu().numpy()),
+                          (f'{split}/u', index, sol)]
                 if force == Force.random:
-                    data_f[f'{split}/f'][c:(c+b), ...] = f
+                    writes.append((f'{split}/f', index, f))
+                writes.append((f'{split}/mu', index, mu))
+                write_queue.put(writes)
 
-                data_f[f'{split}/mu'][c:(c+b)] = mu
+                if write_errors:
+                    raise write_errors[0]
 
                 c += b
 
+        # Finish writing this split before creating the next datasets.
+        write_queue.join()
+        if write_errors:
+            raise write_errors[0]
+
     generate_split(n_train, 'train')
     generate_split(n_valid, 'valid')
     generate_split(n_test, 'test')
+    data_f.close()
 
 
 if __name__ == "__main__":
@@ -84,6 +84,12 @@ def main(config_path: Optional[Path] = Argument(None),
     if 'seed' in config.trainer:
         config.trainer.seed = seed
 
+    # Let float32 matmuls use TF32 ('high') or bfloat16 ('medium'). This is
+    # not a Trainer argument, so we take it out of the trainer config.
+    matmul_precision = config.trainer.pop('matmul_precision', None)
+    if matmul_precision:
+        torch.set_float32_matmul_precision(matmul_precision)
+
     builder = instantiate(config.builder)
     routine = instantiate(config.routine)
     routine.load_lightning_model_state(str(checkpoint_path), map_location)
@@ -94,7 +100,7 @@ def main(config_path: Optional[Path] = Argument(None),
         n_steps = routine.n_steps or (T - 1)
         routine = routine.cuda()
         batch = routine.convert_data(batch)
-        routine.warmup()
+        routine.warmup(batch)
 
         start = time.time()
         routine.infer(batch)
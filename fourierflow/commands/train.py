@@ -62,6 +62,12 @@ def main(config_path: Path,
     if 'seed' in config.trainer:
         config.trainer.seed = seed
 
+    # Let float32 matmuls use TF32 ('high') or bfloat16 ('medium'). This is
+    # not a Trainer argument, so we take it out of the trainer config.
+    matmul_precision = config.trainer.pop('matmul_precision', None)
+    if matmul_precision:
+        torch.set_float32_matmul_precision(matmul_precision)
+
     # Initialize the dataset and experiment modules.
     builder = instantiate(config.builder)
     routine = instantiate(config.routine)
@@ -137,7 +143,7 @@ def main(config_path: Path,
         n_steps = routine.n_steps or (T - 1)
         routine = routine.cuda()
         batch = routine.convert_data(batch)
-        routine.warmup()
+        routine.warmup(batch)
 
         start = time.time()
         routine.infer(batch)
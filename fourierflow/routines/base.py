@@ -21,7 +21,7 @@ class Routine(LightningModule):
         self.accumulate_grad_batches = accumulate_grad_batches
         self.clip_val = clip_val
 
-    def warmup(self):
+    def warmup(self, data=None):
         pass
 
     def optimize_manually(self, loss, batch_idx):
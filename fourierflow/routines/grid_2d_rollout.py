@@ -2,7 +2,6 @@ from typing import Any, Dict
 
 import torch
 import torch.nn as nn
-import wandb
 from einops import rearrange, repeat
 
 from fourierflow.modules import fourier_encode
@@ -108,8 +107,8 @@ class Grid2DRolloutExperiment(Routine):
             embeds = xx
             P = 2
 
-        loss = 0
         step_losses = []
+        preds = []
         # We predict one future one step at a time
         for t in range(self.n_steps):
             y = yy[..., t: t+1]
@@ -121,8 +120,7 @@ class Grid2DRolloutExperiment(Routine):
 
             l = self.l2_loss(im.reshape(B, -1), y.reshape(B, -1))
             step_losses.append(l)
-            loss += l
-            pred = im if t == 0 else torch.cat((pred, im), dim=-1)
+            preds.append(im)
 
             if self.teacher_forcing and self.training:
                 im = y
@@ -135,7 +133,10 @@ class Grid2DRolloutExperiment(Routine):
             else:
                 embeds = torch.cat((embeds[..., 1:], im), dim=-1)
 
-        loss /= self.n_steps
+        loss = torch.stack(step_losses).mean()
+        pred = torch.cat(preds, dim=-1)
+        # pred.shape == [batch_size, *dim_sizes, n_steps]
+
         loss_full = self.l2_loss(pred.reshape(B, -1), yy.reshape(B, -1))
 
         pred_norm = torch.norm(pred, dim=[1, 2], keepdim=True)
@@ -172,6 +173,8 @@ class Grid2DRolloutExperiment(Routine):
         self.log('test_time_until', time_until)
 
         if self.logger:
+            import wandb
+
             times = batch['times'].cpu().numpy()
             corr_rows = list(zip(times, p.cpu().numpy()))
             self.logger.experiment.log({
@@ -70,7 +70,7 @@ class LearnedInterpolator:
         params = optax.apply_updates(params, updates)
         return params, opt_state, loss_value
 
-    def warmup(self):
+    def warmup(self, data=None):
         with init_context():
             inputs = {}
             for i, k in enumerate(['vx', 'vy']):
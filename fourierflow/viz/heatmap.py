@@ -1,8 +1,5 @@
 import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
-import wandb
-from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 
 class MidpointNormalize(mpl.colors.Normalize):
@@ -16,6 +13,11 @@ class MidpointNormalize(mpl.colors.Normalize):
         mpl.colors.Normalize.__init__(self, vmin, vmax, clip)
 
     def __call__(self, value, clip=None):
+        # process_value gives us a float masked array that we can interpolate
+        # in place, without another conversion.
+        result, is_scalar = self.process_value(value)
+        self.autoscale_None(result)
+
         normalized_min = max(
             0, 1 / 2 * (1 - abs((self.midpoint - self.vmin) / (self.midpoint - self.vmax))))
         normalized_max = min(
@@ -23,22 +25,30 @@ class MidpointNormalize(mpl.colors.Normalize):
         normalized_mid = 0.5
         x, y = [self.vmin, self.midpoint, self.vmax], [
             normalized_min, normalized_mid, normalized_max]
-        return np.ma.masked_array(np.interp(value, x, y))
+        result.data[...] = np.interp(result.data, x, y)
+        # Unlike np.interp on the raw value, this keeps any masked entries.
+        return result[0] if is_scalar else result
 
 
 def log_navier_stokes_heatmap(expt, tensor, name, scale):
-    fig = plt.figure(figsize=(6, 6))
+    # These are only needed once we draw, so we import them here to keep the
+    # import of this module cheap.
+    import wandb
+    from matplotlib.figure import Figure
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+    # A standalone Figure isn't tracked by pyplot, so it doesn't need to be
+    # closed afterwards.
+    fig = Figure(figsize=(6, 6))
     ax = fig.add_subplot(1, 1, 1)
     vals = tensor.cpu().numpy()
-    vmax = vals.max()
     vmin = -scale
     vmax = scale
     norm = MidpointNormalize(vmin=vmin, vmax=vmax, midpoint=0)
-    cmap = plt.get_cmap('RdBu')
+    cmap = mpl.colormaps['RdBu']
     im = ax.imshow(vals, interpolation='bilinear', norm=norm, cmap=cmap)
     divider = make_axes_locatable(ax)
     cax = divider.append_axes('right', size='5%', pad=0.05)
     fig.colorbar(im, cax=cax, orientation='vertical')
     fig.tight_layout()
     expt.log({f'{name}': wandb.Image(fig)})
-    plt.close('all')
@@ -0,0 +1,142 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from fourierflow.builders.kolmogorov import (KolmogorovJAXDataset,
+                                             KolmogorovMultiTorchDataset,
+                                             KolmogorovTorchDataset,
+                                             KolmogorovTrajectoryDataset)
+
+B, T, X, Y = 3, 9, 8, 6
+
+
+def make_dataset(seed, times, dims=('sample', 'time', 'x', 'y')):
+    rng = np.random.default_rng(seed)
+    sizes = {'sample': B, 'time': len(times), 'x': X, 'y': Y}
+    shape = [sizes[d] for d in dims]
+    coords = {'x': np.arange(X) * 0.1, 'y': np.arange(Y) * 0.2}
+    if 'time' in dims:
+        coords['time'] = times
+    return xr.Dataset({
+        key: (dims, rng.standard_normal(shape).astype(np.float32))
+        for key in ['vorticity', 'vx', 'vy']
+    }, coords=coords)
+
+
+@pytest.fixture
+def paths(tmp_path):
+    times = np.arange(1, T + 1) * 0.5
+    paths = {
+        'init': tmp_path / 'init.nc',
+        'traj': tmp_path / 'traj.nc',
+        'corr': tmp_path / 'corr.nc',
+    }
+    make_dataset(0, times, dims=('sample', 'x', 'y')).to_netcdf(
+        paths['init'], engine='h5netcdf')
+    make_dataset(1, times).to_netcdf(paths['traj'], engine='h5netcdf')
+    make_dataset(2, np.arange(T + 1) * 0.5).to_netcdf(
+        paths['corr'], engine='h5netcdf')
+    return {k: str(v) for k, v in paths.items()}
+
+
+@pytest.mark.parametrize('in_memory', [False, True])
+@pytest.mark.parametrize('k', [1, 3])
+def test_torch_dataset_matches_isel(paths, k, in_memory):
+    dataset = KolmogorovTorchDataset(paths['traj'], k, in_memory=in_memory)
+    ds = xr.open_dataset(paths['traj'], engine='h5netcdf')
+    assert len(dataset) == B * (T - k)
+
+    for idx in range(len(dataset)):
+        b, t = idx // (T - k), idx % (T - k)
+        sub = ds.isel(sample=b, time=slice(t, t+k+1, k))
+        in_ds = sub.isel(time=slice(0, 1)).transpose('x', 'y', 'time')
+        out_ds = sub.isel(time=slice(1, 2)).transpose('x', 'y', 'time')
+        expected = {
+            'x': in_ds.vorticity.data,
+            'vx': in_ds.vx.data,
+            'vy': in_ds.vy.data,
+            'y': out_ds.vorticity.data,
+        }
+
+        item = dataset[idx]
+        assert item.keys() == expected.keys()
+        for key, value in expected.items():
+            assert item[key].shape == (X, Y, 1)
+            np.testing.assert_array_equal(item[key], value)
+
+
+@pytest.mark.parametrize('in_memory', [False, True])
+@pytest.mark.parametrize('k', [1, 2])
+def test_jax_dataset_matches_isel(paths, k, in_memory):
+    L = 3
+    dataset = KolmogorovJAXDataset(paths['traj'], k, L, in_memory=in_memory)
+    ds = xr.open_dataset(paths['traj'], engine='h5netcdf')
+    assert len(dataset) == B * (T - k * L)
+
+    for idx in range(len(dataset)):
+        b, t = idx // (T - k * L), idx % (T - k * L)
+        sub = ds.isel(sample=b, time=slice(t, t+L*k+1, k))
+        in_ds = sub.isel(time=0)
+        out_ds = sub.isel(time=slice(1, None)).transpose('x', 'y', 'time')
+
+        inputs, outputs = dataset[idx]
+        for key in ['vx', 'vy']:
+            assert inputs[key].shape == (X, Y)
+            assert outputs[key].shape == (X, Y, L)
+            np.testing.assert_array_equal(inputs[key], in_ds[key].data)
+            np.testing.assert_array_equal(outputs[key], out_ds[key].data)
+
+
+@pytest.mark.parametrize('in_memory', [False, True])
+@pytest.mark.parametrize('k', [1, 2])
+def test_trajectory_dataset_matches_isel(paths, k, in_memory):
+    end = T
+    dataset = KolmogorovTrajectoryDataset(
+        paths['init'], paths['traj'], paths['corr'], k, end=end,
+        in_memory=in_memory)
+
+    init_ds = xr.open_dataset(paths['init'], engine='h5netcdf')
+    init_ds = init_ds.expand_dims(dim={'time': [0.0]})
+    ds = xr.concat([init_ds, xr.open_dataset(paths['traj'],
+                                             engine='h5netcdf')], dim='time')
+    ds = ds.transpose('sample', 'x', 'y', 'time')
+    corr_ds = xr.open_dataset(paths['corr'], engine='h5netcdf')
+    corr_ds = corr_ds.transpose('sample', 'x', 'y', 'time')
+    assert len(dataset) == B
+
+    time_slice = slice(None, end, k)
+    n_times = len(range(T + 1)[time_slice])
+    for b in range(B):
+        sub = ds.isel(sample=b, time=time_slice)
+        corr_sub = corr_ds.isel(sample=b, time=time_slice)
+        expected = {
+            'times': sub.time.data,
+            'data': sub.vorticity.data,
+            'vx': sub.vx.data,
+            'vy': sub.vy.data,
+            'corr_data': corr_sub.vorticity.data,
+        }
+
+        item = dataset[b]
+        assert item.keys() == expected.keys()
+        assert item['data'].shape == (X, Y, n_times)
+        for key, value in expected.items():
+            assert item[key].shape == value.shape
+            np.testing.assert_array_equal(item[key], value)
+
+
+def test_torch_dataset_uses_its_chunk_cache(paths):
+    dataset = KolmogorovTorchDataset(paths['traj'], 1)
+    dataset.h5.handle('vorticity')
+    cache = dataset.h5.file.id.get_access_plist().get_cache()
+    assert cache[2] == dataset.h5.rdcc_nbytes
+    dataset.h5.file.close()
+
+
+def test_multi_dataset_uses_its_chunk_cache(paths):
+    dataset = KolmogorovMultiTorchDataset([paths['traj'], paths['corr']], 1, 2)
+    for h5 in dataset.h5s:
+        h5.handle('vorticity')
+        cache = h5.file.id.get_access_plist().get_cache()
+        assert cache[1:3] == (h5.rdcc_nslots, h5.rdcc_nbytes)
+        h5.file.close()
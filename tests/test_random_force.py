@@ -0,0 +1,52 @@
+import math
+
+import pytest
+import torch
+
+from fourierflow.builders.synthetic.ns_2d import get_random_force
+
+
+def get_direct_random_force(alpha, s, cycles, scaling, t, t_scaling):
+    ft = torch.linspace(0, 1, s+1, dtype=torch.float64)[:-1]
+    X, Y = torch.meshgrid(ft, ft, indexing='ij')
+    alpha = alpha.double()[..., None, None]
+
+    f = 0
+    for p in range(1, cycles + 1):
+        k = 2 * math.pi * p
+        a = alpha[:, 6 * (p - 1):6 * p]
+        f += a[:, 0] * torch.sin(k * X + t_scaling * t)
+        f += a[:, 1] * torch.cos(k * X + t_scaling * t)
+        f += a[:, 2] * torch.sin(k * Y + t_scaling * t)
+        f += a[:, 3] * torch.cos(k * Y + t_scaling * t)
+        f += a[:, 4] * torch.sin(k * (X + Y) + t_scaling * t)
+        f += a[:, 5] * torch.cos(k * (X + Y) + t_scaling * t)
+
+    return f * scaling
+
+
+# The first case is a constant force and the second a time-varying one.
+@pytest.mark.parametrize('t,t_scaling', [(0, 0), (0.37, 2.5)])
+def test_random_force_matches_direct_sum(monkeypatch, t, t_scaling):
+    b, s, cycles, scaling = 3, 16, 2, 0.1
+
+    # Record the coefficients that get_random_force draws so that the direct
+    # sum uses exactly the same ones.
+    draws = []
+    rand = torch.rand
+
+    def recording_rand(*args, **kwargs):
+        out = rand(*args, **kwargs)
+        draws.append(out)
+        return out
+
+    monkeypatch.setattr(torch, 'rand', recording_rand)
+    f = get_random_force(b, s, 'cpu', cycles, scaling, t, t_scaling, seed=42)
+    monkeypatch.undo()
+
+    alpha = torch.cat(draws, dim=1)
+    assert alpha.shape == (b, cycles * 6)
+
+    expected = get_direct_random_force(alpha, s, cycles, scaling, t, t_scaling)
+    assert f.shape == (b, s, s)
+    torch.testing.assert_close(f.double(), expected, rtol=0, atol=1e-5)